@@ -1,33 +1,73 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
 import uvicorn
+import asyncio
 import os
+import orjson
 import time
-import tempfile
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Optional
 from pydantic import BaseModel, Field
+import numpy as np
 
-from faster_whisper import WhisperModel
+# Faster fp16 GEMM reductions on tensor cores; must be set before CTranslate2 loads
+os.environ.setdefault("CT2_CUDA_ALLOW_FP16_REDUCED_PRECISION_REDUCTION", "1")
+
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from faster_whisper.audio import decode_audio
+
+from serialize import segment_to_dict
+
+# Whisper models expect 16 kHz mono input
+SAMPLING_RATE = 16000
+
+# Default model, loaded at startup
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "large-v3-turbo")
+# Default device, also decides how many server workers to run
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "cuda")
+# Threads per CPU model; CPU deployments run cpu_count // WHISPER_CPU_THREADS workers
+WHISPER_CPU_THREADS = int(os.environ.get("WHISPER_CPU_THREADS", "4"))
+# Set by the main entry so worker processes know they don't share a model
+WHISPER_WORKERS = int(os.environ.get("WHISPER_WORKERS", "1"))
+
+# CTranslate2 models are not reentrant on one CUDA stream, so cap concurrent decodes
+WHISPER_CONCURRENCY = int(os.environ.get("WHISPER_CONCURRENCY", "1"))
+gpu_semaphore = asyncio.Semaphore(WHISPER_CONCURRENCY)
+transcribe_pool = ThreadPoolExecutor(max_workers=WHISPER_CONCURRENCY, thread_name_prefix="whisper")
+# Audio decoding is CPU-only, so it gets its own pool and overlaps with transcription
+decode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="decode")
+
+# GPU compute types that run on fp16/bf16 kernels; "auto" picks one of these on
+# Ampere+, the only GPUs with flash attention
+FLASH_ATTENTION_COMPUTE_TYPES = ("auto", "float16", "bfloat16", "int8_float16", "int8_bfloat16")
 
 # Model instance and info
-default_model = None
-default_model_info = {"size": "", "device": "", "loaded": False}
+model = None
+batched_model = None
+model_info = {"size": "", "device": "", "compute_type": "", "requested_compute_type": "", "loaded": False}
+# Serializes loads so concurrent callers don't build the same model twice
+model_lock = threading.Lock()
 
 # Lifespan event handler
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("API starting, loading default model...")
-    load_model()
+    await load_and_warm_up_model()
     yield
     print("API shutting down...")
+    transcribe_pool.shutdown(wait=False)
+    decode_pool.shutdown(wait=False)
 
 app = FastAPI(
     title="Faster Whisper API", 
     description="Voice transcription API",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -39,39 +79,130 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def load_model(model_size="large-v3", device="cuda"):
-    """Load or switch model"""
-    global model, model_info
-    
+def load_model(model_size=WHISPER_MODEL, device=WHISPER_DEVICE, compute_type="auto"):
+    """Load or switch model
+
+    compute_type only applies to the GPU path; "auto" lets CTranslate2 pick the
+    fastest type the device supports (e.g. int8_float16 on Turing/Ampere, float32
+    on Pascal cards without fast float16). The CPU path always uses int8.
+    model_info reports the type CTranslate2 actually picked, alongside the
+    requested one used to detect an unchanged config.
+
+    large-v3-turbo is the default: it keeps the large-v3 encoder but has a 4-layer
+    decoder instead of 32, so decoding is roughly 4x faster at similar accuracy.
+    """
+    global model, batched_model, model_info
+    with model_lock:
+        # Switching to the same config would rebuild a multi-GB model for nothing
+        if (model_info["loaded"] and model_info["size"] == model_size and model_info["device"] == device
+                and model_info["requested_compute_type"] == (compute_type if device == "cuda" else "int8")):
+            return {"success": True, "message": f"Model already loaded: {model_size}"}
+        try:
+            if device == "cuda":
+                print(f"Loading GPU model: {model_size}...")
+                # CTranslate2's flash attention only runs fp16/bf16 kernels, and may only
+                # reject other types at the first decode, so never enable it for them
+                flash_attention = compute_type in FLASH_ATTENTION_COMPUTE_TYPES
+                try:
+                    model = WhisperModel(model_size, device="cuda", compute_type=compute_type, flash_attention=flash_attention)
+                except Exception as e:
+                    # Pre-Ampere GPUs reject flash attention at load; retry only for that,
+                    # anything else goes to the CPU fallback
+                    if not flash_attention or "flash" not in str(e).lower():
+                        raise
+                    print(f"Flash attention unavailable: {e}")
+                    model = WhisperModel(model_size, device="cuda", compute_type=compute_type)
+                batched_model = BatchedInferencePipeline(model=model)
+                model_info = {"size": model_size, "device": "cuda", "compute_type": model.model.compute_type, "requested_compute_type": compute_type, "loaded": True}
+                return {"success": True, "message": f"Successfully loaded GPU model: {model_size}"}
+            else:
+                print(f"Loading CPU model: {model_size}...")
+                model = WhisperModel(model_size, device="cpu", compute_type="int8", cpu_threads=WHISPER_CPU_THREADS)
+                batched_model = BatchedInferencePipeline(model=model)
+                model_info = {"size": model_size, "device": "cpu", "compute_type": model.model.compute_type, "requested_compute_type": "int8", "loaded": True}
+                return {"success": True, "message": f"Successfully loaded CPU model: {model_size}"}
+        except Exception as e:
+            if device == "cuda":
+                try:
+                    print(f"GPU load failed: {e}")
+                    print("Fallback to CPU mode...")
+                    model = WhisperModel("small", device="cpu", compute_type="int8", cpu_threads=WHISPER_CPU_THREADS)
+                    batched_model = BatchedInferencePipeline(model=model)
+                    model_info = {"size": "small", "device": "cpu", "compute_type": model.model.compute_type, "requested_compute_type": "int8", "loaded": True}
+                    return {"success": True, "message": f"GPU load of {model_size} failed, fallback to CPU model (small)"}
+                except Exception as e2:
+                    model_info = {"size": "", "device": "", "compute_type": "", "requested_compute_type": "", "loaded": False}
+                    return {"success": False, "error": f"Model load failed: {str(e2)}"}
+            else:
+                model_info = {"size": "", "device": "", "compute_type": "", "requested_compute_type": "", "loaded": False}
+                return {"success": False, "error": f"CPU model load failed: {str(e)}"}
+
+def warm_up_model():
+    """Run a second of silence through the model so the first request skips kernel setup"""
+    print("Warming up model...")
+    silence = np.zeros(SAMPLING_RATE, dtype=np.float32)
+    # Greedy is the endpoint default, beam search is the common opt-in
+    for beam_size in (1, 5):
+        segments, _ = model.transcribe(silence, language="en", beam_size=beam_size, vad_filter=False)
+        for _ in segments:
+            pass
+    # The batched pipeline has its own encoder shapes and generate call; 1 s is below
+    # chunk_length, so it runs as a single clip without VAD
+    segments, _ = batched_model.transcribe(silence, language="en", vad_filter=False, batch_size=8)
+    for _ in segments:
+        pass
+
+async def load_and_warm_up_model(*args):
+    """load_model, then warm up if a new model was actually loaded
+
+    A GPU model can load and still fail its first decode (e.g. missing cuDNN), so a
+    failed warm-up falls back to the small CPU model like a failed GPU load does.
+    """
+    global model_info
+    loop = asyncio.get_running_loop()
+    previous_model = model
+    result = await loop.run_in_executor(None, partial(load_model, *args))
+    if not model_info["loaded"] or model is previous_model:
+        return result
     try:
-        if device == "cuda":
-            print(f"Loading GPU model: {model_size}...")
-            model = WhisperModel(model_size, device="cuda", compute_type="float16")
-            model_info = {"size": model_size, "device": "cuda", "loaded": True}
-            return {"success": True, "message": f"Successfully loaded GPU model: {model_size}"}
-        else:
-            print(f"Loading CPU model: {model_size}...")
-            model = WhisperModel(model_size, device="cpu", compute_type="int8")
-            model_info = {"size": model_size, "device": "cpu", "loaded": True}
-            return {"success": True, "message": f"Successfully loaded CPU model: {model_size}"}
+        # Same slot and pool as /transcribe so warm-up never overlaps a live decode
+        async with gpu_semaphore:
+            await loop.run_in_executor(transcribe_pool, warm_up_model)
+        return result
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+        error = str(e)
+    if model_info["device"] == "cuda":
+        print("Fallback to CPU mode...")
+        result = await load_and_warm_up_model("small", "cpu")
+        if result["success"]:
+            result["message"] = "GPU warm-up failed, fallback to CPU model (small)"
+        return result
+    with model_lock:
+        model_info = {"size": "", "device": "", "compute_type": "", "requested_compute_type": "", "loaded": False}
+    return {"success": False, "error": f"Model warm-up failed: {error}"}
+
+def drain_segments(segments_generator, start_time, put, cancelled):
+    """Decode every segment on the worker thread, passing NDJSON lines to put; None ends the stream"""
+    try:
+        for segment in segments_generator:
+            if cancelled.is_set():
+                return
+            put(orjson.dumps(segment_to_dict(segment)) + b"\n")
+        transcribe_time = time.time() - start_time
+        print(f"Transcribe time: {transcribe_time:.2f}s")
+        put(orjson.dumps({"duration": round(transcribe_time, 2)}) + b"\n")
     except Exception as e:
-        if device == "cuda":
-            try:
-                print(f"GPU load failed: {e}")
-                print("Fallback to CPU mode...")
-                model = WhisperModel("small", device="cpu", compute_type="int8")
-                model_info = {"size": "small", "device": "cpu", "loaded": True}
-                return {"success": True, "message": f"GPU load failed, fallback to CPU model (small)"}
-            except Exception as e2:
-                model_info = {"size": "", "device": "", "loaded": False}
-                return {"success": False, "error": f"Model load failed: {str(e2)}"}
-        else:
-            model_info = {"size": "", "device": "", "loaded": False}
-            return {"success": False, "error": f"CPU model load failed: {str(e)}"}
+        # Headers are already sent, so report the failure in-band
+        print(f"Transcribe error: {str(e)}")
+        put(orjson.dumps({"success": False, "error": str(e)}) + b"\n")
+    finally:
+        put(None)
 
 class ModelRequest(BaseModel):
-    model_size: str = Field(default="large-v3", description="Model size (tiny, base, small, medium, large-v1, large-v2, large-v3)")
-    device: str = Field(default="cuda", description="Device (cuda, cpu)")
+    model_size: str = Field(default=WHISPER_MODEL, description="Model size (tiny, base, small, medium, large-v1, large-v2, large-v3, large-v3-turbo)")
+    device: str = Field(default=WHISPER_DEVICE, description="Device (cuda, cpu)")
+    compute_type: str = Field(default="auto", description="GPU compute type (auto, int8_float16, float16, int8, float32)")
 
 @app.get("/")
 def read_root():
@@ -84,79 +215,135 @@ def read_root():
     }
 
 @app.post("/load_model")
-def api_load_model(request: ModelRequest):
+async def api_load_model(request: ModelRequest):
     """Load or switch model"""
-    result = load_model(request.model_size, request.device)
+    if WHISPER_WORKERS > 1:
+        # Each worker process has its own model, a switch would only reach one of them
+        raise HTTPException(status_code=409, detail=f"Model switching is disabled with {WHISPER_WORKERS} workers, set WHISPER_MODEL instead")
+    result = await load_and_warm_up_model(request.model_size, request.device, request.compute_type)
     return result
 
 @app.post("/transcribe")
 async def transcribe_audio(
     audio: UploadFile = File(...),
     language: str = Form("zh"),
-    beam_size: int = Form(5),
+    beam_size: int = Form(1),
+    temperature: str = Form("0.0,0.2,0.4,0.6,0.8,1.0"),
+    no_speech_threshold: float = Form(0.6),
     vad_filter: bool = Form(True),
-    word_timestamps: bool = Form(True)
+    word_timestamps: bool = Form(True),
+    batch_size: int = Form(1)
 ):
-    """Transcribe uploaded audio file and return result"""
+    """Transcribe uploaded audio file and stream the result as NDJSON
+
+    The first line holds the detected language and model, each following line is
+    one segment as soon as it is decoded, and the last line holds the duration
+    (or an error object if decoding fails midway).
+
+    beam_size defaults to 1 (greedy decoding), which is several times cheaper than
+    beam search and good enough for short clips; pass beam_size=5 when accuracy on
+    long or noisy audio matters more than speed. temperature is a comma-separated
+    fallback schedule, retried only when a decode fails the quality thresholds.
+    no_speech_threshold sets how confident the model must be that a window is
+    silent before it is skipped.
+
+    Batching is opt-in: with vad_filter on and batch_size > 1, the speech chunks
+    found by VAD are decoded together in batches of batch_size, keeping the GPU busy
+    on long audio. Batched decoding uses only the first temperature (no fallback)
+    and does not condition on previous text, so it can trade some accuracy for speed.
+    """
     global model, model_info
+
+    try:
+        temperature_param = tuple(float(t) for t in temperature.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid temperature: {temperature}")
     
-    # Ensure model is loaded
+    # Ensure model is loaded, load_model is a no-op if another request got there first
     if not model_info["loaded"]:
-        load_result = load_model()
+        load_result = await load_and_warm_up_model()
         if not load_result["success"]:
             raise HTTPException(status_code=500, detail="Model loading failed")
     
-    # Create temp file
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio.filename)[1])
     try:
-        shutil.copyfileobj(audio.file, temp_file)
-        temp_file.close()
-        lang_param = None if language == "auto" else language
-        print(f"Transcribing file: {audio.filename}")
-        start_time = time.time()
-        segments_generator, info = model.transcribe(
-            temp_file.name,
-            language=lang_param,
-            beam_size=beam_size,
-            vad_filter=vad_filter,
-            word_timestamps=word_timestamps
+        # Decode in-process straight from the upload, no temp file round-trip
+        audio_data = await asyncio.get_running_loop().run_in_executor(
+            decode_pool, partial(decode_audio, audio.file, sampling_rate=SAMPLING_RATE)
         )
-        transcribe_time = time.time() - start_time
-        print(f"Transcribe time: {transcribe_time:.2f}s")
+    except Exception as e:
+        print(f"Transcribe error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    lang_param = None if language == "auto" else language
+    # The batched pipeline splits audio on VAD chunks, so it needs vad_filter
+    if vad_filter and batch_size > 1:
+        transcribe = partial(batched_model.transcribe, batch_size=batch_size)
+    else:
+        transcribe = model.transcribe
+
+    async def stream_segments():
+        """Yield one NDJSON line per segment as the model decodes it"""
+        loop = asyncio.get_running_loop()
+        # Hold a GPU slot until decoding finishes, not until the client has read everything
+        await gpu_semaphore.acquire()
+        try:
+            print(f"Transcribing file: {audio.filename}")
+            start_time = time.time()
+            segments_generator, info = await loop.run_in_executor(
+                transcribe_pool,
+                partial(
+                    transcribe,
+                    audio_data,
+                    language=lang_param,
+                    beam_size=beam_size,
+                    temperature=temperature_param,
+                    no_speech_threshold=no_speech_threshold,
+                    vad_filter=vad_filter,
+                    word_timestamps=word_timestamps
+                )
+            )
+        except BaseException:
+            gpu_semaphore.release()
+            raise
         print(f"Detected language: {info.language} (prob: {info.language_probability:.2f})")
-        segments_list = list(segments_generator)
-        segments_data = []
-        full_text = ""
-        for segment in segments_list:
-            segment_dict = {
-                "start": segment.start,
-                "end": segment.end,
-                "text": segment.text
-            }
-            if hasattr(segment, 'words') and segment.words:
-                segment_dict["words"] = [
-                    {"word": word.word, "start": word.start, "end": word.end}
-                    for word in segment.words
-                ]
-            segments_data.append(segment_dict)
-            full_text += segment.text + " "
-        return {
-            "success": True,
-            "language": info.language,
-            "language_probability": round(info.language_probability, 2),
-            "duration": round(transcribe_time, 2),
-            "model": model_info["size"],
-            "device": model_info["device"],
-            "text": full_text.strip(),
-            "segments": segments_data
-        }
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        drain = loop.run_in_executor(
+            transcribe_pool,
+            drain_segments,
+            segments_generator,
+            start_time,
+            partial(loop.call_soon_threadsafe, queue.put_nowait),
+            cancelled
+        )
+        drain.add_done_callback(lambda _: gpu_semaphore.release())
+        try:
+            yield orjson.dumps({
+                "success": True,
+                "language": info.language,
+                "language_probability": round(info.language_probability, 2),
+                "model": model_info["size"],
+                "device": model_info["device"]
+            }) + b"\n"
+            while (line := await queue.get()) is not None:
+                yield line
+        finally:
+            # Client went away or the stream ended: stop decoding for nobody
+            cancelled.set()
+
+    # Run up to the first line here so transcribe failures still map to HTTP 500
+    lines = stream_segments()
+    try:
+        first_line = await anext(lines)
     except Exception as e:
         print(f"Transcribe error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Remove temp file
-        if os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
+
+    async def body():
+        yield first_line
+        async for line in lines:
+            yield line
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 @app.get("/model_info")
 def get_model_info():
@@ -166,9 +353,22 @@ def get_model_info():
 # Main entry
 if __name__ == "__main__":
     print("Starting Faster Whisper API...")
+    if WHISPER_DEVICE == "cpu":
+        # Independent CPU models scale across processes
+        workers = max(1, (os.cpu_count() or 1) // WHISPER_CPU_THREADS)
+    else:
+        # One process per GPU, concurrency comes from batching instead
+        workers = 1
+    print(f"Workers: {workers}")
+    # Inherited by the worker processes
+    os.environ["WHISPER_WORKERS"] = str(workers)
+    # loop/http "auto" use uvloop and httptools when installed (not available on Windows)
     uvicorn.run(
         "main:app", 
         host="0.0.0.0", 
         port=8080, 
         reload=False,
-    ) 
\ No newline at end of file
+        workers=workers,
+        loop="auto",
+        http="auto",
+    ) 
@@ -0,0 +1,40 @@
+"""Segment serialization for the transcribe stream.
+
+Fully annotated and mypyc-clean, but left interpreted: measured with mypyc on
+CPython 3.10 and 3.11, compiling it was slower, since every attribute read on
+faster-whisper's Word/Segment still goes through the generic Python API.
+"""
+from typing import Any, Dict, List, Optional, Protocol
+
+
+# Structural types for faster-whisper's Word/Segment; faster-whisper ships no
+# py.typed marker, so mypy/mypyc cannot use its classes directly
+class Word(Protocol):
+    word: str
+    start: float
+    end: float
+
+
+class Segment(Protocol):
+    start: float
+    end: float
+    text: str
+    words: Optional[List[Word]]
+
+
+def segment_to_dict(segment: Segment) -> Dict[str, Any]:
+    """Convert a faster-whisper Segment to a JSON-ready dict, timestamps rounded to 10 ms"""
+    segment_dict: Dict[str, Any] = {
+        "start": round(segment.start, 2),
+        "end": round(segment.end, 2),
+        "text": segment.text,
+    }
+    # words is always set, None unless word_timestamps was requested; faster-whisper
+    # already rounds word timestamps to 10 ms
+    words = segment.words
+    if words:
+        segment_dict["words"] = [
+            {"word": word.word, "start": word.start, "end": word.end}
+            for word in words
+        ]
+    return segment_dict
@@ -1,5 +1,6 @@
 import requests
 import os
+import json
 import time
 
 """
@@ -20,40 +21,52 @@ def test_transcribe_api():
     print("🚀 Uploading file and requesting transcription...")
     start_time = time.time()
     try:
-        files = {
-            'audio': open(audio_file, 'rb')
-        }
         data = {
             'language': 'zh',
             'beam_size': 5,
             'vad_filter': 'true',
             'word_timestamps': 'true'
         }
-        response = requests.post(api_url, files=files, data=data)
-        request_time = time.time() - start_time
-        print(f"⏱️ API request time: {request_time:.2f}s")
-        files['audio'].close()
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('success', False):
-                print("\n✅ Transcription succeeded!")
-                print("-" * 50)
-                print(f"🔤 Detected language: {result.get('language', 'unknown')}")
-                print(f"🎯 Language probability: {result.get('language_probability', 0)}")
-                print(f"⏱️ Transcribe time: {result.get('duration', 0):.2f}s")
-                print(f"💻 Model: {result.get('model', 'unknown')} ({result.get('device', 'unknown')})")
-                print("\n📝 Full transcript:")
-                print("-" * 50)
-                print(result.get('text', ''))
-                print("-" * 50)
-                print("\n⏲️ Segments with timestamps:")
-                for i, segment in enumerate(result.get('segments', []), 1):
-                    print(f"{i}. [{segment['start']:.2f}s -> {segment['end']:.2f}s] {segment['text']}")
+        # File and response are closed even if the request fails; stream=True reads the NDJSON reply line by line
+        with open(audio_file, 'rb') as fh, requests.post(
+            api_url,
+            files={'audio': (os.path.basename(audio_file), fh, 'audio/mpeg')},
+            data=data,
+            stream=True
+        ) as response:
+            if response.status_code == 200:
+                lines = (json.loads(line) for line in response.iter_lines() if line)
+                result = next(lines, {'error': 'Empty response'})
+                if result.get('success', False):
+                    print("\n✅ Transcription started!")
+                    print("-" * 50)
+                    print(f"🔤 Detected language: {result.get('language', 'unknown')}")
+                    print(f"🎯 Language probability: {result.get('language_probability', 0)}")
+                    print(f"💻 Model: {result.get('model', 'unknown')} ({result.get('device', 'unknown')})")
+                    print(f"⏱️ Time to first line: {time.time() - start_time:.2f}s")
+                    print("\n⏲️ Segments with timestamps:")
+                    texts = []
+                    i = 0
+                    for line in lines:
+                        if 'start' in line:
+                            i += 1
+                            texts.append(line['text'])
+                            print(f"{i}. [{line['start']:.2f}s -> {line['end']:.2f}s] {line['text']}")
+                        elif 'error' in line:
+                            print(f"❌ API error: {line['error']}")
+                        else:
+                            print(f"⏱️ Transcribe time: {line.get('duration', 0):.2f}s")
+                    request_time = time.time() - start_time
+                    print(f"⏱️ API request time: {request_time:.2f}s")
+                    print("\n📝 Full transcript:")
+                    print("-" * 50)
+                    print(" ".join(texts).strip())
+                    print("-" * 50)
+                else:
+                    print(f"❌ API error: {result.get('error', 'Unknown error')}")
             else:
-                print(f"❌ API error: {result.get('error', 'Unknown error')}")
-        else:
-            print(f"❌ HTTP error: {response.status_code}")
-            print(response.text)
+                print(f"❌ HTTP error: {response.status_code}")
+                print(response.text)
     except Exception as e:
         print(f"❌ Exception: {str(e)}")
 